@@ -3,6 +3,11 @@
 
 import collections
 import csv
+import itertools
+import logging
+import math
+import multiprocessing
+import sys
 import click
 import numpy as np
 import psycopg2
@@ -12,14 +17,35 @@ import matplotlib.style as style
 from matplotlib import cm
 from matplotlib.dates import MINUTELY, DateFormatter, rrulewrapper, RRuleLocator, drange, MinuteLocator
 from matplotlib.ticker import MaxNLocator, MultipleLocator, FormatStrFormatter, AutoMinorLocator
-from datetime import datetime, timedelta
 from postgis import register
-from haversine import haversine, Unit
+from psycopg2 import sql
 
 
 colors = ["#E58606","#5D69B1","#52BCA3","#99C945","#CC61B0","#24796C","#DAA51B","#2F8AC4","#764E9F","#ED645A","#CC3A8E","#A5AA99",
           "#88CCEE","#CC6677","#DDCC77","#117733","#332288","#AA4499","#44AA99","#999933","#882255","#661100","#6699CC","#888888"]
-colordict = {"i": 0}
+# Each bus gets the next color of the palette the first time it is plotted
+colorcycle = itertools.cycle(colors)
+colordict = collections.defaultdict(lambda: next(colorcycle))
+
+logger = logging.getLogger(__name__)
+
+# Bus stops information as parallel arrays (latitudes and longitudes in radians)
+StopsArrays = collections.namedtuple("StopsArrays", ["ids", "dists", "lats", "lngs", "terms"])
+
+# Mean Earth radius (in meters), the same used by the haversine package
+EARTH_RADIUS = 6371008.8
+
+
+def configureLogging(level):
+    """ Configures logging, showing this script's messages from the given level on
+
+    Only this module's logger gets the level, so that libraries (e.g., matplotlib) keep logging warnings only.
+    It is also used as the initializer of the processes that process buses.
+
+    :param level: the logging level of this script's messages
+    """
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(level)
 
 
 def getColor(busID, d):
@@ -28,40 +54,78 @@ def getColor(busID, d):
     # else:
     #     return "#50b28d"
 
-    i = colordict["i"]
-    if busID not in colordict:
-        colordict[busID] = i
-        colordict["i"] = (i + 1) % len(colors)
-    else:
-        i = colordict[busID]
-
-    return colors[i]
+    return colordict[busID]
 
 
 def connectDB(db, dbuser, dbpass, line, spacing):
     # Connect to the PostgreSQL Database
-    dbConnection = psycopg2.connect("dbname='{0}' user='{1}' password='{2}'".format(db, dbuser, dbpass))
+    dbConnection = psycopg2.connect(dbname=db, user=dbuser, password=dbpass)
     register(dbConnection)
 
-    # Create a DB cursor and basic view for the script
+    # Create a DB cursor and basic tables for the script
     dbCursor = dbConnection.cursor()
-
-    # DB Line View
-    dbLineViewSQL = """
-                    CREATE OR REPLACE VIEW LinhaInterpolada AS 
-                    SELECT (ST_DumpPoints(ST_LineInterpolatePoints(wkb_geometry, {0}))).path[1],
-                           (ST_DumpPoints(ST_LineInterpolatePoints(wkb_geometry, {0}))).geom
-                    FROM linha{1};
-                    """.format(spacing, line)
-    dbCursor.execute(dbLineViewSQL)
-
-    # DB MultiPoint Function
-    dbMultiFunctionSQL = """
-                         CREATE OR REPLACE FUNCTION ST_AsMultiPoint(geometry) RETURNS geometry AS
-                         'SELECT ST_Union((d).geom) FROM ST_DumpPoints(ST_LineInterpolatePoints($1, {0})) AS d;'
-                         LANGUAGE sql IMMUTABLE STRICT COST 10;
-                         """.format(spacing)
-    dbCursor.execute(dbMultiFunctionSQL)
+    lineTable = sql.Identifier("linha{0}".format(line))
+    interpolatedLineTable = sql.Identifier("linha{0}_interpolada".format(line))
+
+    # DB Line Spatial Index (ogr2ogr usually creates one when importing the line)
+    dbCursor.execute("SELECT 1 FROM pg_indexes WHERE tablename = %s AND indexdef ILIKE %s",
+                     ("linha{0}".format(line), "%USING gist%"))
+    if dbCursor.fetchone() is None:
+        dbCursor.execute(sql.SQL("CREATE INDEX ON {0} USING GIST (wkb_geometry);").format(lineTable))
+
+    # DB Interpolated Line Table
+    # Materialized and indexed, since it is looked up for every AVL position
+    # Each point also stores the travelled distance up to it (cumulative sum of the segments' lengths)
+    dbLineTableSQL = sql.SQL("""
+                     DROP TABLE IF EXISTS {1};
+                     CREATE UNLOGGED TABLE {1} AS
+                     SELECT path, geom,
+                            coalesce(sum(ST_Distance(prevgeom::geography, geom::geography)) OVER (ORDER BY path), 0)
+                            AS travdist
+                     FROM (
+                         SELECT pts.path, pts.geom, lag(pts.geom) OVER (ORDER BY pts.path) AS prevgeom
+                         FROM (
+                             SELECT (ST_DumpPoints(ST_LineInterpolatePoints(wkb_geometry, %(spacing)s))).path[1] AS path,
+                                    (ST_DumpPoints(ST_LineInterpolatePoints(wkb_geometry, %(spacing)s))).geom AS geom
+                             FROM {0}
+                         ) AS pts
+                     ) AS segs;
+                     CREATE INDEX ON {1} USING GIST (geom);
+                     CREATE INDEX ON {1} (path);
+                     ANALYZE {1};
+                     """).format(lineTable, interpolatedLineTable)
+    dbCursor.execute(dbLineTableSQL, {"spacing": spacing})
+
+    # DB Travelled Distance Function
+    # Map matches a position to the line and returns both the travelled distance and whether the position is an
+    # outlier (i.e., it is 250 meters or more away from the bus line), so that a single round-trip is needed for
+    # each position
+    dbTravDistanceFunctionSQL = sql.SQL("""
+                                DROP FUNCTION IF EXISTS get_trav_distance(float8, float8);
+                                CREATE FUNCTION get_trav_distance(lat float8, lng float8)
+                                RETURNS TABLE(travdist float8, isoutlier bool) AS
+                                $$
+                                WITH nn AS (
+                                    SELECT linhainterpolada.geom
+                                    FROM {1} AS linhainterpolada
+                                    ORDER BY linhainterpolada.geom <-> ST_SetSRID(ST_MakePoint(lng, lat), 4326)
+                                    LIMIT 1
+                                ), idx AS (
+                                    SELECT linhainterpolada.travdist
+                                    FROM {1} AS linhainterpolada, nn
+                                    WHERE linhainterpolada.geom ~= nn.geom AND linhainterpolada.geom = nn.geom
+                                    ORDER BY linhainterpolada.path
+                                    LIMIT 1
+                                )
+                                SELECT idx.travdist,
+                                       (SELECT ST_Distance(ST_SetSRID(ST_MakePoint(lng, lat), 4326)::geography,
+                                                           linha.wkb_geometry::geography) >= 250
+                                        FROM {0} AS linha)
+                                FROM idx;
+                                $$
+                                LANGUAGE sql STABLE;
+                                """).format(lineTable, interpolatedLineTable)
+    dbCursor.execute(dbTravDistanceFunctionSQL)
 
     dbConnection.commit()
     return (dbConnection, dbCursor)
@@ -98,92 +162,131 @@ def buildStopsFromFile(stopsFileName):
     return stops
 
 
+def buildStopsArrays(busStops):
+    """Build parallel arrays containing the bus stops information, sorted by travelled distance
+
+    :param busStops: a dictionary containing bus stops information
+    :return: a StopsArrays with the bus stops ids, travelled distances, latitudes and longitudes (in radians)
+             and terminal flags
+    """
+    sortedStops = sorted(busStops.values(), key=lambda stop: stop["dist"])
+
+    return StopsArrays(ids=np.array([stop["id"] for stop in sortedStops], dtype=np.int64),
+                       dists=np.array([stop["dist"] for stop in sortedStops], dtype=np.int64),
+                       lats=np.radians(np.array([stop["lat"] for stop in sortedStops], dtype=np.float64)),
+                       lngs=np.radians(np.array([stop["lng"] for stop in sortedStops], dtype=np.float64)),
+                       terms=np.array([stop["term"] for stop in sortedStops], dtype=bool))
 
-def getTravDistance(lat, lng, busLine, dbCursor):
-    """ Returns the total travelled distance to position (lat, lng) in the given bus line
-    :param lat: the bus's latitude position
-    :param lng: the bus's longitude position
-    :param busLine: the bus line
+
+def readAVL(avlFileName, line, start, end, dbCursor):
+    """Read the AVL data of a given bus line and time period from a given file
+
+    This function bulk loads avlFileName into a temporary table using COPY, so that the type parsing is done by
+    the database server. Then, it selects every AVL record of the given bus line that is in service within the
+    [start, end) hour range, map matching each position to the bus line within the same query.
+    The file is assumed to be ordered by date, so records past the first one after the end hour are discarded.
+
+    :param avlFileName: the AVL file
+    :param line: the bus line
+    :param start: start hour
+    :param end: end hour
     :param dbCursor: a cursor to the database
-    :return: total distanced travelled in meters to the position specified
+    :return: a server-side cursor streaming (date, line, busID, lat, lng, direcao, estado, letreiro,
+             travelled distance, outlier flag) tuples in file order
     """
-    # Map matching to discover closest point (projected)
-    closestPointSQL = """
-                      SELECT ST_ClosestPoint(ST_AsMultiPoint(linha.wkb_geometry), pt.geometry) AS ponto
-                      FROM ST_GeomFromText('POINT({0} {1})', 4326) AS pt, 
-                      linha{2} AS linha
-                      """.format(lng, lat, busLine)
-    dbCursor.execute(closestPointSQL)
-    closestPoint = dbCursor.fetchone()
-
-    # Get the index of map matched point
-    pointIndexSQL = """
-                    SELECT path, geom
-                    FROM LinhaInterpolada
-                    WHERE geom = %s
-                    """
-    dbCursor.execute(pointIndexSQL, (closestPoint))
-    pointIndex = dbCursor.fetchone()
-
-    # Get Travelled Distance
-    distanceSQL = """
-                  SELECT ST_Length(ST_MakeLine(linhainterpolada.geom), true)
-                  FROM LinhaInterpolada AS linhainterpolada
-                  WHERE path <= %s
-                  """
-    dbCursor.execute(distanceSQL, [pointIndex[0]])
-    distance = dbCursor.fetchone()[0]
-
-    return distance
-
-
-def outlier(lat, lng, line, dbCursor):
-    """ Check if a given latitude and longitude point is an outlier, i.e., it is not within the bus line buffer
-
-    :param lat: latitude of the point
-    :param lng: longitude of the point
-    :param line: the busline id
-    :param dbCursor: the database cursor
-    :return: True if the point is over 100 meters of the line, False otherwise
+    avlColumnTypes = {
+        "data": "timestamp",
+        "idlinha": "int",
+        "idonibus": "int",
+        "lat": "float8",
+        "lng": "float8",
+        "direcao": "int"
+    }
+
+    avlFile = open(avlFileName)
+    avlHeader = next(csv.reader([avlFile.readline()]))
+
+    # AVL Temporary Table (seq keeps the file order)
+    avlColumns = sql.SQL(", ").join(sql.SQL("{0} {1}").format(sql.Identifier(c), sql.SQL(avlColumnTypes.get(c, "text")))
+                                    for c in avlHeader)
+    dbCursor.execute(sql.SQL("CREATE TEMP TABLE avl_tmp (seq bigserial, {0}) ON COMMIT DROP;").format(avlColumns))
+
+    # Bulk load the AVL file
+    # Empty text fields (e.g., letreiro) are loaded as empty strings, not NULL, just like csv.reader reads them
+    avlTextColumns = [c for c in avlHeader if c not in avlColumnTypes]
+    avlCopySQL = sql.SQL("COPY avl_tmp ({0}) FROM STDIN WITH (FORMAT csv{1})").format(
+        sql.SQL(", ").join(map(sql.Identifier, avlHeader)),
+        sql.SQL(", FORCE_NOT_NULL ({0})").format(sql.SQL(", ").join(map(sql.Identifier, avlTextColumns)))
+        if avlTextColumns else sql.SQL(""))
+    dbCursor.copy_expert(avlCopySQL.as_string(dbCursor), avlFile)
+    avlFile.close()
+
+    # Filter and map match the AVL data
+    avlSQL = """
+             WITH corte AS (
+                 SELECT min(seq) AS seq
+                 FROM avl_tmp
+                 WHERE date_part('hour', data) >= %(end)s
+             )
+             SELECT avl.data, avl.idlinha, avl.idonibus, avl.lat, avl.lng, avl.direcao, avl.estado, avl.letreiro,
+                    d.travdist, d.isoutlier
+             FROM avl_tmp AS avl
+             CROSS JOIN corte
+             LEFT JOIN LATERAL get_trav_distance(avl.lat, avl.lng) AS d ON true
+             WHERE avl.idlinha = %(line)s
+               AND date_part('hour', avl.data) >= %(start)s AND date_part('hour', avl.data) < %(end)s
+               AND avl.letreiro <> 'FORA DE SERVICO'
+               AND (corte.seq IS NULL OR avl.seq < corte.seq)
+             ORDER BY avl.seq
+             """
+    avlCursor = dbCursor.connection.cursor(name="avlcursor")
+    avlCursor.itersize = 10000
+    avlCursor.execute(avlSQL, {"line": line, "start": start, "end": end})
+
+    return avlCursor
+
+
+def haversineDistance(lat, lng, otherLat, otherLng):
+    """ Returns the great-circle distance between two positions
+    :param lat: the first position's latitude
+    :param lng: the first position's longitude
+    :param otherLat: the second position's latitude
+    :param otherLng: the second position's longitude
+    :return: distance in meters between the two positions
     """
-    pointDistanceSQL = """
-                       SELECT ST_Distance(pt, linha.wkb_geometry, true)
-                       FROM ST_GeomFromText('POINT({0} {1})', 4326) AS pt,
-                            linha{2} AS linha
-                       """.format(lng, lat, line)
-    dbCursor.execute(pointDistanceSQL)
-    pointDistance = dbCursor.fetchone()
-
-    if pointDistance[0] >= 250:
-        return True
-    else:
-        return False
+    lat, lng, otherLat, otherLng = map(math.radians, (lat, lng, otherLat, otherLng))
+    a = math.sin((otherLat - lat) / 2) ** 2 + math.cos(lat) * math.cos(otherLat) * math.sin((otherLng - lng) / 2) ** 2
 
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
 
-def getLastBusStop(lat, lng, travDistance, busStops):
-    lastStop = busStops[1]
-    within = False
 
-    for id, stop in busStops.items():
-        if stop["term"] and haversine((lat, lng), (stop["lat"], stop["lng"]), unit=Unit.METERS) <= 100:
-            lastStop = stop
-            within = True
-            break
-        elif not stop["term"] and haversine((lat, lng), (stop["lat"], stop["lng"]), unit=Unit.METERS) <= 15:
-            lastStop = stop
-            break
-        elif stop["dist"] <= travDistance:
-            lastStop = stop
+def getLastBusStop(lat, lng, travDistance, busStops, stopsArrays):
+    # A bus stop close to the position takes precedence over the travelled distance
+    # Haversine distance from the position to every bus stop at once
+    latRad = math.radians(lat)
+    lngRad = math.radians(lng)
+    a = (np.sin((stopsArrays.lats - latRad) / 2) ** 2
+         + math.cos(latRad) * np.cos(stopsArrays.lats) * np.sin((stopsArrays.lngs - lngRad) / 2) ** 2)
+    stopsDistances = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
 
-    return lastStop, within
+    # Terminals are matched within 100 meters, regular stops within 15 meters
+    near = np.where(stopsArrays.terms, stopsDistances <= 100, stopsDistances <= 15)
+    if near.any():
+        i = near.argmax()
+        return busStops[int(stopsArrays.ids[i])], bool(stopsArrays.terms[i])
+
+    # Otherwise, the last bus stop is the farthest one whose distance was already travelled
+    lastStop = busStops[1]
+    i = np.searchsorted(stopsArrays.dists, travDistance, side="right") - 1
+    if i >= 0:
+        lastStop = busStops[int(stopsArrays.ids[i])]
 
+    return lastStop, False
 
-def getVelocityAndDistance(tx, ty, tp, line, dbCursor):
-    lat, lng = tp[-1]
-    prevLat, prevLng = tp[-2]
 
-    distance = getTravDistance(lat, lng, line, dbCursor)
-    prevDistance = getTravDistance(prevLat, prevLng, line, dbCursor)
+def getVelocityAndDistance(tx, tdist):
+    distance = tdist[-1]
+    prevDistance = tdist[-2]
 
     date = tx[-1]
     prevDate = tx[-2]
@@ -191,42 +294,282 @@ def getVelocityAndDistance(tx, ty, tp, line, dbCursor):
     # We travelled through at least one bus stops
     # Compute the velocity to get to the current position
     deltaDistance = distance - prevDistance
-    deltaDate = (date - prevDate).total_seconds()
+    deltaDate = (date - prevDate) / np.timedelta64(1, "s")
     velocity = deltaDistance / deltaDate
 
     return velocity, distance
 
 
-def processAVL(avlFileName, line, spacing, start, end, busStops, dbCursor):
-    # List of raw headway at each stop
-    rawHeadway = collections.defaultdict(list)
+def interpolateStopTimes(prevDate, prevDistance, velocity, stopDistances):
+    """ Estimates the time a bus passed through a sequence of bus stops, assuming it kept a constant velocity
+    since its previous position
 
-    # Last registered position of a given bus
-    lastRegBusPosition = collections.defaultdict(dict)
+    :param prevDate: the date of the bus's previous position
+    :param prevDistance: the travelled distance (in meters) of the bus's previous position
+    :param velocity: the bus's velocity (in meters per second)
+    :param stopDistances: array containing the travelled distance (in meters) of each passed bus stop
+    :return: a datetime64 array containing the time the bus passed through each bus stop
+    """
+    if velocity == 0:
+        return np.full(len(stopDistances), np.datetime64(prevDate, "us"))
 
-    # Last registered bus stop
-    lastRegBusStop = collections.defaultdict(dict)
+    offsets = np.rint((stopDistances - prevDistance) / velocity * 1e6).astype("timedelta64[us]")
+    return np.datetime64(prevDate, "us") + offsets
 
-    # Historical position of vehicles
-    historicalAVL = dict()
 
-    # Headway Trips (by busID)
-    trips = collections.defaultdict(dict)
+class TripBuffer:
+    """ Growable column buffers holding the bus stops a bus passed through in a trip
 
-    # Read AVL file
-    avlFile = open(avlFileName)
-    avlReader = csv.DictReader(avlFile)
+    Each entry stores the time the bus passed through the bus stop (x), the date of the AVL record it was estimated
+    from (d), the bus stop id (y), and the position (lat, lng) and travelled distance (dist) of that AVL record.
+    The buffers double their capacity when full, and the columns are exposed as views of the filled entries.
+    """
+    COLUMNS = ("_x", "_d", "_y", "_lat", "_lng", "_dist")
+
+    def __init__(self, capacity=64):
+        self.n = 0
+        self._x = np.empty(capacity, dtype="datetime64[us]")
+        self._d = np.empty(capacity, dtype="datetime64[us]")
+        self._y = np.empty(capacity, dtype=np.int32)
+        self._lat = np.empty(capacity, dtype=np.float64)
+        self._lng = np.empty(capacity, dtype=np.float64)
+        self._dist = np.empty(capacity, dtype=np.float64)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def x(self):
+        return self._x[:self.n]
+
+    @property
+    def d(self):
+        return self._d[:self.n]
+
+    @property
+    def y(self):
+        return self._y[:self.n]
+
+    @property
+    def lat(self):
+        return self._lat[:self.n]
+
+    @property
+    def lng(self):
+        return self._lng[:self.n]
+
+    @property
+    def dist(self):
+        return self._dist[:self.n]
+
+    def append(self, x, d, y, lat, lng, dist):
+        if self.n == len(self._x):
+            for column in TripBuffer.COLUMNS:
+                setattr(self, column, np.resize(getattr(self, column), 2 * self.n))
+
+        self.n = self.n + 1
+        self.setLast(x, d, y, lat, lng, dist)
+
+    def setLast(self, x, d, y, lat, lng, dist):
+        i = self.n - 1
+        self._x[i] = x
+        self._d[i] = d
+        self._y[i] = y
+        self._lat[i] = lat
+        self._lng[i] = lng
+        self._dist[i] = dist
+
+    def clear(self):
+        self.n = 0
+
+
+def processBusAVL(busID, busAVL, busStops, stopsArrays):
+    """ Process the AVL data of a single bus, registering the time it passed through each bus stop
+
+    The trajectory of a bus only depends on its own AVL data, thus each bus can be processed independently.
+
+    :param busID: the bus id
+    :param busAVL: list of (index, date, line, lat, lng, direcao, estado, letreiro, travelled distance, outlier flag)
+                   tuples of the bus, in file order
+    :param busStops: a dictionary containing bus stops information
+    :param stopsArrays: a StopsArrays with the bus stops information, sorted by travelled distance
+    :return: a tuple containing the clean AVL records, the finished trips and the unfinished trip of the bus
+    """
+    # AVL data of the bus by column
+    avlDates = [avl[1] for avl in busAVL]
+    avlLats = np.array([avl[3] for avl in busAVL], dtype=np.float64)
+    avlLngs = np.array([avl[4] for avl in busAVL], dtype=np.float64)
+    avlDists = np.array([avl[8] for avl in busAVL], dtype=np.float64)
 
-    # Periodiciade e Numero de Dados
-    periodicidade = []
-    numdadosbrutos = 0
-    numdadosfiltro = 0
+    # Last registered position of the bus (its index in the AVL data, -1 if none)
+    lastRegBusPosition = -1
 
-    # Clean Dataset
+    # Last registered bus stop (its id, 0 if none)
+    lastRegBusStop = 0
+
+    # Headway Trip
+    trip = TripBuffer()
+
+    # Finished Trips (index of the AVL record that finished them, times and bus stops)
+    finishedTrips = []
+
+    # Clean AVL records (with their index)
+    cleanAVL = []
+
+    for avlIndex, (fileIndex, date, busLine, lat, lng, direcao, estado, letreiro, distance, isOutlier) in enumerate(busAVL):
+        logger.debug("%s %s", busID, busAVL[avlIndex])
+
+        # Check if data is duplicate
+        if lastRegBusPosition >= 0:
+            if avlLats[lastRegBusPosition] == lat and avlLngs[lastRegBusPosition] == lng:
+                logger.debug("POSIÇÃO IDÊNTICA do busID %s", busID)
+                continue
+
+        # Check if AVL data is an outlier (going to garage, maintenance)
+        if isOutlier:
+            lastRegBusPosition = avlIndex
+            lastRegBusStop = 0
+            continue
+
+        # Save to clean AVL
+        cleanAVL.append((fileIndex, [date, busLine, busID, lat, lng, direcao, estado, letreiro]))
+
+        # Ok, AVL is not an outlier
+        # Retrieve the last bus stop that this AVL has travelled
+        lastBusStop, within = getLastBusStop(lat, lng, distance, busStops, stopsArrays)
+
+        # Retrieve the last registered bus stop that this AVL has travelled (that we registered)
+        # Check if we have registered anything previously
+        if not lastRegBusStop:
+            # Ok, we have nothing
+            # So, we register this bus stop
+            lastRegBusPosition = avlIndex
+            lastRegBusStop = lastBusStop["id"]
+
+            trip.clear()
+            trip.append(date, date, lastBusStop["id"], lat, lng, distance)
+            logger.debug("INICIALIZANDO a lista do busID %s", busID)
+            continue
+        else:
+            # Yes, we do have a previous record of this bus!
+            # Let's get the data from the last registered bus position
+            prevAVL = lastRegBusPosition
+            prevDate = avlDates[prevAVL]
+            prevLat = avlLats[prevAVL]
+            prevLng = avlLngs[prevAVL]
+            prevDistance = avlDists[prevAVL]
+            prevStopIndex = lastRegBusStop
+
+            # Data muito passada
+            if (
+                    (busStops[lastRegBusStop]["term"]
+                        and (date - trip.x[-1].item()).total_seconds() > 120
+                        and haversineDistance(lat, lng, trip.lat[-1], trip.lng[-1]) <= 100)
+                or
+                    (busStops[lastRegBusStop]["term"]
+                        and (date - prevDate).total_seconds() > 300)
+                or
+                    (distance <= prevDistance and lastRegBusStop != lastBusStop["id"]
+                       and len(trip) < 5)
+            ):
+                lastRegBusPosition = avlIndex
+                lastRegBusStop = lastBusStop["id"]
+                trip.setLast(date, date, lastBusStop["id"], lat, lng, distance)
+                logger.debug("REINICIALIZANDO a lista do busID %s", busID)
+                continue
+
+            # Check if AVL has finished the trip (went back to first stop)
+            if (len(trip) <= 2 and
+                lastRegBusStop > lastBusStop["id"] and lastBusStop["id"] == 1):
+                lastRegBusPosition = prevAVL
+                lastRegBusStop = lastBusStop["id"]
+
+                trip.clear()
+                trip.append(prevDate, prevDate, lastBusStop["id"], prevLat, prevLng, prevDistance)
+                logger.debug("BUGGGG da lista do busID %s", busID)
+                continue
+            elif lastRegBusStop > lastBusStop["id"] and lastBusStop["id"] <= 2:
+                lastRegBusPosition = avlIndex
+                lastRegBusStop = lastBusStop["id"]
+
+                if len(trip):
+                    trip.append(date, date, 37, lat, lng, distance)
+                    finishedTrips.append((fileIndex, trip.x.copy(), trip.y.copy()))
+
+                    trip.clear()
+                    lastRegBusStop = 0
+
+                continue
+            elif lastRegBusStop > lastBusStop["id"]:
+                lastRegBusPosition = avlIndex
+                continue
+            elif (lastBusStop["id"] == 35 or lastBusStop["id"] == 36) and lastRegBusStop == 1:
+                logger.debug("CURVINHA INICIAL do busID %s", busID)
+                lastRegBusPosition = avlIndex
+                continue
+
+            # Get the number of travelled stops (diff between current and previous registered)
+            numTravStops = int(lastBusStop["id"]) - lastRegBusStop
+
+            if numTravStops > 0:
+                # We travelled through at least one bus stops
+                # Compute the velocity to get to the current position
+                deltaDistance = distance - prevDistance
+                deltaDate = (date - prevDate).total_seconds()
+                velocity = deltaDistance / deltaDate
+
+                # Compute the headway time for each travelled bus stop
+                passedStops = [busStops[prevStopIndex + i + 1] for i in range(numTravStops)]
+                passedTimes = interpolateStopTimes(prevDate, prevDistance, velocity,
+                                                   np.array([stop["dist"] for stop in passedStops]))
+
+                for passedStop, timePassedAtBusStop in zip(passedStops, passedTimes):
+                    trip.append(timePassedAtBusStop, date, passedStop["id"], lat, lng, distance)
+
+            lastRegBusPosition = avlIndex
+            lastRegBusStop = lastBusStop["id"]
+
+    return cleanAVL, finishedTrips, trip
+
+
+def processAVL(avlFileName, line, spacing, start, end, busStops, dbCursor, workers):
+    # Raw headway (bus stop, bus and time of each passage through a bus stop), as arrays for each plotted trip
+    # Starts with empty arrays, so that they can always be concatenated
+    rawStopIDs = [np.empty(0, dtype=np.int32)]
+    rawBusIDs = [np.empty(0, dtype=np.int32)]
+    rawTimes = [np.empty(0, dtype="datetime64[us]")]
+
+    # Bus stops sorted by travelled distance
+    stopsArrays = buildStopsArrays(busStops)
+
+    # Read AVL file and group its data by bus (keeping the file order)
+    avlCursor = readAVL(avlFileName, line, start, end, dbCursor)
+
+    busesAVL = collections.defaultdict(list)
+    for index, (date, busLine, busID, lat, lng, direcao, estado, letreiro, distance, isOutlier) in enumerate(avlCursor):
+        busesAVL[busID].append((index, date, busLine, lat, lng, direcao, estado, letreiro, distance, isOutlier))
+
+    avlCursor.close()
+
+    # Process each bus independently (in parallel if more than one worker is given)
+    busesArgs = [(busID, busAVL, busStops, stopsArrays) for busID, busAVL in busesAVL.items()]
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=configureLogging, initargs=(logger.level,)) as pool:
+            busesResults = pool.starmap(processBusAVL, busesArgs)
+    else:
+        busesResults = [processBusAVL(*busArgs) for busArgs in busesArgs]
+
+    busesResults = dict(zip(busesAVL.keys(), busesResults))
+
+    # Clean Dataset (in the file order)
     cleanAVLFile = open(avlFileName + ".clean.csv", "w+", newline="")
     cleanAVLWriter = csv.writer(cleanAVLFile, delimiter=',')
     cleanAVLWriter.writerow(["DATA", "LINHA", "LATITUDE", "LONGITUDE", "DIRECAO", "ESTADO", "LETREIRO"])
 
+    cleanAVL = [record for busResults in busesResults.values() for record in busResults[0]]
+    cleanAVL.sort(key=lambda record: record[0])
+    cleanAVLWriter.writerows(row for _, row in cleanAVL)
+
     # Graphics Config
     style.use("seaborn-paper")
     fig, ax = plt.subplots()
@@ -245,244 +588,75 @@ def processAVL(avlFileName, line, spacing, start, end, busStops, dbCursor):
     #
     plt.yticks(ytick, ylabel)
 
-    # Process AVL data
-    for avlData in avlReader:
-        # Check if AVL's date and busline match the provided date and line period
-        date = datetime.strptime(avlData["data"], "%Y-%m-%d %H:%M:%S")
-        busLine = int(avlData["idlinha"])
-        busID = int(avlData["idonibus"])
-        lat = float(avlData["lat"])
-        lng = float(avlData["lng"])
-        direcao = int(avlData["direcao"])
-        estado = avlData["estado"]
-        letreiro = avlData["letreiro"]
-
-        avl = {
-            "date": date,
-            "line": busLine,
-            "busID": busID,
-            "lat": lat,
-            "lng": lng
-        }
-
-        if busLine == line and start <= date.hour < end and letreiro != "FORA DE SERVICO":
-            print(avl)
-            numdadosbrutos = numdadosbrutos + 1
-
-            # Check if data is duplicate
-            if lastRegBusPosition[busID]:
-                if lastRegBusPosition[busID]["lat"] == lat and lastRegBusPosition[busID]["lng"] == lng:
-                    print("POSIÇÃO IDÊNTICA")
-                    continue
-
-            # Check if AVL data is an outlier (going to garage, maintenance)
-            if outlier(lat, lng, line, dbCursor):
-                lastRegBusPosition[busID] = avl
-                if busID in lastRegBusStop:
-                    del lastRegBusStop[busID]
-                continue
+    # Salva e plota as viagens completas (na ordem em que terminaram)
+    finishedTrips = [(index, busID, tx, ty)
+                     for busID, busResults in busesResults.items() for index, tx, ty in busResults[1]]
+    finishedTrips.sort(key=lambda finishedTrip: finishedTrip[0])
 
-            # Write to clean AVL File
-            cleanAVLWriter.writerow([date, busLine, busID, lat, lng, direcao, estado, letreiro])
-            cleanAVLFile.flush()
+    for _, busID, tx, ty in finishedTrips:
+        plt.plot_date(tx, ty, "-", color = getColor(busID, tx[0]), marker="o", markersize=5)
 
-            numdadosfiltro = numdadosfiltro + 1
+        rawStopIDs.append(ty)
+        rawBusIDs.append(np.full(len(ty), busID, dtype=np.int32))
+        rawTimes.append(tx)
 
-            # Ok, AVL is not an outlier
-            # Get Travelled Distance
-            distance = getTravDistance(lat, lng, line, dbCursor)
+    # Salva e plota dados que não completaram (na ordem do primeiro registro limpo de cada ônibus)
+    unfinishedTrips = [(busResults[0][0][0], busID, busResults[2])
+                       for busID, busResults in busesResults.items() if busResults[0]]
+    unfinishedTrips.sort(key=lambda unfinishedTrip: unfinishedTrip[0])
 
-            # Retrieve the last bus stop that this AVL has travelled
-            lastBusStop, within = getLastBusStop(lat, lng, distance, busStops)
+    for _, busID, trip in unfinishedTrips:
+        if len(trip) > 3 and trip.x[0].item().hour >= start :
+            toFinishStop = 37 - int(trip.y[-1])
 
-            # Retrieve the last registered bus stop that this AVL has travelled (that we registered)
-            # Check if we have registered anything previously
-            if not lastRegBusStop[busID]:
-                # Ok, we have nothing
-                # So, we register this bus stop
-                lastRegBusPosition[busID] = avl
-                lastRegBusStop[busID] = lastBusStop
+            if toFinishStop < 3 and toFinishStop > 0:
+                velocity, prevDistance = getVelocityAndDistance(trip.x, trip.dist)
+                prevDate = trip.x[-1]
+                prevStopIndex = int(trip.y[-1])
+                lastDate = trip.d[-1]
+                lastLat = trip.lat[-1]
+                lastLng = trip.lng[-1]
 
-                trips[busID]["x"] = [date]
-                trips[busID]["d"] = [date]
-                trips[busID]["y"] = [lastBusStop["id"]]
-                trips[busID]["p"] = [(lat, lng)]
-                print("INICIALIZANDO a lista do busID", busID)
-                continue
-            else:
-                # Yes, we do have a previous record of this bus!
-                # Let's get the data from the last registered bus position
-                prevAVL = lastRegBusPosition[busID]
-                prevDate = prevAVL["date"]
-                prevLat = prevAVL["lat"]
-                prevLng = prevAVL["lng"]
-                prevDistance = getTravDistance(prevLat, prevLng, line, dbCursor)
-                prevStopIndex = lastRegBusStop[busID]["id"]
-                _, prevWithin = getLastBusStop(prevLat, prevLng, distance, busStops)
-
-                # Salva a periodiciade de envio
-                periodicidade.append((date - prevDate).total_seconds())
-
-                # Data muito passada
-                if (
-                        (lastRegBusStop[busID]["term"]
-                            and (date - trips[busID]["x"][-1]).total_seconds() > 120
-                            and haversine((lat, lng), trips[busID]["p"][-1], unit=Unit.METERS) <= 100)
-                    or
-                        (lastRegBusStop[busID]["term"]
-                            and (date - prevDate).total_seconds() > 300)
-                    or
-                        (distance <= prevDistance and lastRegBusStop[busID]["id"] != lastBusStop["id"]
-                           and len(trips[busID]["x"]) < 5)
-                ):
-                    lastRegBusPosition[busID] = avl
-                    lastRegBusStop[busID] = lastBusStop
-                    trips[busID]["x"][-1] = date
-                    trips[busID]["d"][-1] = date
-                    trips[busID]["y"][-1] = lastBusStop["id"]
-                    trips[busID]["p"][-1] = (lat, lng)
-                    print("REINICIALIZANDO a lista do busID", busID)
-                    continue
-
-                # Check if AVL has finished the trip (went back to first stop)
-                if (len(trips[busID]["x"]) <= 2 and
-                    lastRegBusStop[busID]["id"] > lastBusStop["id"] and lastBusStop["id"] == 1):
-                    lastRegBusPosition[busID] = prevAVL
-                    lastRegBusStop[busID] = lastBusStop
-
-                    trips[busID]["x"] = [prevDate]
-                    trips[busID]["d"] = [prevDate]
-                    trips[busID]["y"] = [lastBusStop["id"]]
-                    trips[busID]["p"] = [(prevLat, prevLng)]
-                    print("BUGGGG da lista do busID", busID)
-                    continue
-                elif lastRegBusStop[busID]["id"] > lastBusStop["id"] and lastBusStop["id"] <= 2:
-                    if len(trips[busID]["x"]) > 36:
-                        print("parou aqui q da merda")
-
-                    lastRegBusPosition[busID] = avl
-                    lastRegBusStop[busID] = lastBusStop
-
-                    if len(trips[busID]["x"]):
-                        trips[busID]["x"].append(date)
-                        trips[busID]["d"].append(date)
-                        trips[busID]["y"].append(37)
-                        trips[busID]["p"].append((lat, lng))
-                        plt.plot_date(trips[busID]["x"], trips[busID]["y"], "-", color = getColor(busID, trips[busID]["x"][0]), marker="o", markersize=5)
-
-                        # rawHeadway[passedStop["id"]].append((busID, timePassedAtBusStop))
-                        for i in range(len(trips[busID]["x"])):
-                            rawHeadway[trips[busID]["y"][i]].append((busID, trips[busID]["x"][i]))
-
-                        trips[busID]["x"] = []
-                        trips[busID]["d"] = []
-                        trips[busID]["y"] = []
-                        trips[busID]["p"] = []
-                        del lastRegBusStop[busID]
-
-                    continue
-                elif lastRegBusStop[busID]["id"] > lastBusStop["id"]:
-                    lastRegBusPosition[busID] = avl
-                    continue
-                elif (lastBusStop["id"] == 35 or lastBusStop["id"] == 36) and lastRegBusStop[busID]["id"] == 1:
-                    print("CURVINHA INICIAL")
-                    lastRegBusPosition[busID] = avl
-                    continue
-
-                # Get the number of travelled stops (diff between current and previous registered)
-                numTravStops = int(lastBusStop["id"]) - int(lastRegBusStop[busID]["id"])
-
-                if numTravStops > 0:
-
-                    if lastBusStop["id"] == 2 and lastRegBusStop[busID]["id"] == 33:
-                        print("deu pau")
-
-                    # We travelled through at least one bus stops
-                    # Compute the velocity to get to the current position
-                    deltaDistance = distance - prevDistance
-                    deltaDate = (date - prevDate).total_seconds()
-                    velocity = deltaDistance / deltaDate
-
-                    # Compute the headway time for each travelled bus stop
-                    for i in range(numTravStops):
-                        passedStop = busStops[prevStopIndex + i + 1]
-                        distancePassedBusStop = passedStop["dist"] - prevDistance
-                        timePassedAtBusStop = prevDate
-                        if velocity != 0:
-                            timePassedAtBusStop = prevDate + timedelta(seconds=(distancePassedBusStop / velocity))
-
-                        if trips[busID]["x"]:
-                            if trips[busID]["x"][-1] >= timePassedAtBusStop:
-                                print("WTF!!!!")
-
-                        # rawHeadway[passedStop["id"]].append((busID, timePassedAtBusStop))
-                        if (timePassedAtBusStop.hour == 1 and timePassedAtBusStop.minute == 30 and timePassedAtBusStop.second == 10):
-                            print("WTF ")
-
-                        trips[busID]["x"].append(timePassedAtBusStop)
-                        trips[busID]["d"].append(date)
-                        trips[busID]["y"].append(passedStop["id"])
-                        trips[busID]["p"].append((lat, lng))
-
-
-                lastRegBusPosition[busID] = avl
-                lastRegBusStop[busID] = lastBusStop
-
-        if date.hour >= end:
-            break
-
-    # Salva e plota dados que não completaram
-    for busID in trips:
-        if busID in trips:
-            if "y" in trips[busID] and len(trips[busID]["y"]) > 3 and trips[busID]["x"][0].hour >= start :
-                toFinishStop = 37 - trips[busID]["y"][-1]
-
-                if toFinishStop < 3 and toFinishStop > 0:
-                    velocity, prevDistance = getVelocityAndDistance(trips[busID]["x"], trips[busID]["y"], trips[busID]["p"], line, dbCursor)
-                    prevDate = trips[busID]["x"][-1]
-                    prevStopIndex = trips[busID]["y"][-1]
-
-                    for i in range(toFinishStop):
-                        distancePassedBusStop = 14525 - prevDistance
-                        stopid = 37
-                        if (prevStopIndex + i + 1) != 37:
-                            passedStop = busStops[prevStopIndex + i + 1]
-                            distancePassedBusStop = passedStop["dist"] - prevDistance
-                            stopid = passedStop["id"]
-
-                        timePassedAtBusStop = prevDate
-                        if velocity != 0:
-                            timePassedAtBusStop = prevDate + timedelta(seconds=(distancePassedBusStop / velocity))
-
-                        trips[busID]["x"].append(timePassedAtBusStop)
-                        trips[busID]["y"].append(stopid)
-                        trips[busID]["p"].append((lat, lng))
-
-                plt.plot_date(trips[busID]["x"], trips[busID]["y"], "-", color = getColor(busID, trips[busID]["x"][0]), marker="o", markersize=5)
-
-                for i in range(len(trips[busID]["x"])):
-                    rawHeadway[trips[busID]["y"][i]].append((busID, trips[busID]["x"][i]))
+                # The last stop (37) is the first terminal again, at the end of the line
+                passedStopIDs = [prevStopIndex + i + 1 for i in range(toFinishStop)]
+                passedDists = [busStops[stopid]["dist"] if stopid != 37 else 14525 for stopid in passedStopIDs]
+                passedTimes = interpolateStopTimes(prevDate, prevDistance, velocity, np.array(passedDists))
+
+                for stopid, timePassedAtBusStop in zip(passedStopIDs, passedTimes):
+                    trip.append(timePassedAtBusStop, lastDate, stopid, lastLat, lastLng, prevDistance)
+
+            plt.plot_date(trip.x, trip.y, "-", color = getColor(busID, trip.x[0]), marker="o", markersize=5)
+
+            rawStopIDs.append(trip.y)
+            rawBusIDs.append(np.full(len(trip), busID, dtype=np.int32))
+            rawTimes.append(trip.x)
 
     plt.show()
     cleanAVLFile.close()
+
+    rawHeadway = {
+        "stop": np.concatenate(rawStopIDs),
+        "bus": np.concatenate(rawBusIDs),
+        "time": np.concatenate(rawTimes)
+    }
     return rawHeadway
 
 
 def deriveHeadway(rawHeadway):
     headway = dict()
 
-    for busStopID in sorted(rawHeadway.keys()):
-        rawHeadwaysAtStop = rawHeadway[busStopID]
-        rawHeadwaysAtStop.sort(key=lambda x: x[1])
-        headwayAtStopList = []
+    if not len(rawHeadway["stop"]):
+        return headway
 
-        # Get all time difference pairs at a given bus stop and do the pairwise headway computation
-        for prev, next in list(zip(rawHeadwaysAtStop[:-1], rawHeadwaysAtStop[1:])):
-            computedHeadway = (next[1] - prev[1]).total_seconds()
-            headwayAtStopList.append(computedHeadway)
+    # Sort the passages by bus stop and time, and split them at each bus stop boundary
+    order = np.lexsort((rawHeadway["time"], rawHeadway["stop"]))
+    stopIDs = rawHeadway["stop"][order]
+    times = rawHeadway["time"][order]
+    boundaries = np.flatnonzero(np.diff(stopIDs)) + 1
 
-        # Generate Numpy Array
-        headway[busStopID] = np.array(headwayAtStopList)
+    # The headway is the difference between consecutive passages at the same bus stop
+    for busStopID, passTimes in zip(stopIDs[np.r_[0, boundaries]], np.split(times, boundaries)):
+        headway[int(busStopID)] = np.diff(passTimes) / np.timedelta64(1, "s")
 
     return headway
 
@@ -490,11 +664,9 @@ def deriveHeadway(rawHeadway):
 def writeOutput(processedHeadway, output):
     for busStopID in sorted(processedHeadway.keys()):
         outputfilename = "out/ponto." + str(busStopID) + "." + output
-        with open(outputfilename, 'a+', newline='') as outfile:
-            writer = csv.writer(outfile, delimiter=',')
-            # writer.writerow(["headway"])
-            for h in processedHeadway[busStopID]:
-                writer.writerow([h])
+        with open(outputfilename, 'ab') as outfile:
+            # outfile.write(b"headway\n")
+            np.savetxt(outfile, processedHeadway[busStopID], fmt="%s", newline="\r\n")
 
 
 @click.command()
@@ -509,7 +681,11 @@ def writeOutput(processedHeadway, output):
 @click.option("--dbuser",  default="ufg",                              help="PostGreSQL User")
 @click.option("--dbpass",  default="ufgufg",                           help="PostGreSQL Password")
 @click.option("--output",  default="output.csv",                       help="Output file")
-def main(avl, line, stops, spacing, start, end, headway, db, dbuser, dbpass, output):
+@click.option("--workers", default=1,                                  help="Number of processes used to process buses")
+@click.option("--debug",   is_flag=True,                               help="Log the processing of every AVL record")
+def main(avl, line, stops, spacing, start, end, headway, db, dbuser, dbpass, output, workers, debug):
+    configureLogging(logging.DEBUG if debug else logging.WARNING)
+
     # Create DB connection and get a cursor
     dbConnection, dbCursor = connectDB(db, dbuser, dbpass, line, spacing)
 
@@ -519,7 +695,7 @@ def main(avl, line, stops, spacing, start, end, headway, db, dbuser, dbpass, out
     # Retrieve Raw Headways
     # Raw here means that we are just storing the datetime where a bus passes through the stop
     # We will calculate the headway (the difference between such occurrences) later
-    rawHeadway = processAVL(avl, line, spacing, start, end, busStops, dbCursor)
+    rawHeadway = processAVL(avl, line, spacing, start, end, busStops, dbCursor, workers)
 
     # Now, lets derive the Headway data for every bus stop from raw headway
     processedHeadway = deriveHeadway(rawHeadway)
@@ -529,13 +705,22 @@ def main(avl, line, stops, spacing, start, end, headway, db, dbuser, dbpass, out
 
     # Output some statistics
     print("MEAN", "MIN", "MAX", "STDEV")
-    for busStopID in sorted(processedHeadway.keys()):
-        headwayAtStop = processedHeadway[busStopID]
-        cvh = np.std(headwayAtStop - headway) / headway
-        media = np.mean(headwayAtStop)
-        min = np.min(headwayAtStop)
-        max = np.max(headwayAtStop)
-        print(busStopID, cvh, np.std(headwayAtStop), media, media/60, min, min/60, max, max/60)
+    busStopIDs = sorted(busStopID for busStopID in processedHeadway.keys() if len(processedHeadway[busStopID]) > 0)
+    if busStopIDs:
+        # Matriz com os headways de cada ponto por linha, completada com NaN
+        maxLen = max(len(processedHeadway[busStopID]) for busStopID in busStopIDs)
+        headwayMatrix = np.full((len(busStopIDs), maxLen), np.nan)
+        for i, busStopID in enumerate(busStopIDs):
+            headwayMatrix[i, :len(processedHeadway[busStopID])] = processedHeadway[busStopID]
+
+        cvh = np.nanstd(headwayMatrix - headway, axis=1) / headway
+        desvio = np.nanstd(headwayMatrix, axis=1)
+        media = np.nanmean(headwayMatrix, axis=1)
+        minimo = np.nanmin(headwayMatrix, axis=1)
+        maximo = np.nanmax(headwayMatrix, axis=1)
+
+        writer = csv.writer(sys.stdout, delimiter=' ', lineterminator='\n')
+        writer.writerows(zip(busStopIDs, cvh, desvio, media, media/60, minimo, minimo/60, maximo, maximo/60))
 
     print("FINISHED PROCESSING")
 
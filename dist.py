@@ -1,5 +1,8 @@
 import csv
-from geopy.distance import vincenty
+import numpy as np
+
+# Raio médio da Terra (em metros)
+RAIO_TERRA = 6371008.8
 
 estados = {}
 cidades = {}
@@ -37,13 +40,19 @@ for linha in leitorarqmunicipios:
 cod_mun_base = 1721000
 lat_base = cidades[cod_mun_base]["latitude"]
 lng_base = cidades[cod_mun_base]["longitude"]
-loc_base = (lat_base, lng_base)
 
-for cid_cod_ibge, cidade_detalhe in cidades.items():
-    loc_cidade = (cidade_detalhe["latitude"], cidade_detalhe["longitude"])
-    dist_base = vincenty(loc_base, loc_cidade).meters
+# Distância (haversine) de todas as cidades até a cidade base de uma só vez
+lat_cidades = np.radians([cidade_detalhe["latitude"] for cidade_detalhe in cidades.values()])
+lng_cidades = np.radians([cidade_detalhe["longitude"] for cidade_detalhe in cidades.values()])
+lat_base_rad = np.radians(lat_base)
+lng_base_rad = np.radians(lng_base)
+
+a = (np.sin((lat_cidades - lat_base_rad) / 2) ** 2
+     + np.cos(lat_base_rad) * np.cos(lat_cidades) * np.sin((lng_cidades - lng_base_rad) / 2) ** 2)
+dist_base = 2 * RAIO_TERRA * np.arcsin(np.sqrt(a))
 
-    cidade_detalhe["distancia"] = dist_base
+for cidade_detalhe, dist_cidade in zip(cidades.values(), dist_base.tolist()):
+    cidade_detalhe["distancia"] = dist_cidade
 
 cidades_ordenada = sorted(cidades.items(), key=lambda k: k[1]["distancia"])
 